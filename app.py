@@ -1,14 +1,25 @@
-from fastapi import FastAPI, HTTPException, Form, UploadFile
+from fastapi import FastAPI, HTTPException, Form, UploadFile, BackgroundTasks
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import hashlib
+import logging
 import os
-import tempfile
+import uuid
 from audiocraft.models import JASCO
 from audiocraft.data.audio import audio_write
+import torch
 import torchaudio
-import ffmpeg
+import julius
+import numpy as np
+import orjson
+
+# Module logger; debug messages are dropped at the default WARNING level
+logger = logging.getLogger(__name__)
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -22,8 +33,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Run inference on the GPU when one is available
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
 # Initialize models
 jasco_chords_drums = JASCO.get_pretrained('facebook/jasco-chords-drums-400M', 
+                            device=DEVICE,
                             chords_mapping_path='assets/chord_to_index_mapping.pkl')
 
 # Set default prompt, chords, drums
@@ -31,138 +46,542 @@ DEFAULT_PROMPT = "Strings, woodwind, orchestral, symphony."
 DEFAULT_CHORDS = [('Am7', 0.0), ('D7', 5.0), ('G', 8.0)]
 DEFAULT_DRUMS_WAV, DEFAULT_DRUMS_SR = torchaudio.load("./assets/sample_0.wav")
 
+# Downmix and resample the default drums once so requests can use them as-is
+if DEFAULT_DRUMS_SR != jasco_chords_drums.sample_rate:
+    DEFAULT_DRUMS_WAV = julius.resample_frac(DEFAULT_DRUMS_WAV.mean(0, keepdim=True), DEFAULT_DRUMS_SR, jasco_chords_drums.sample_rate)
+    DEFAULT_DRUMS_SR = jasco_chords_drums.sample_rate
+elif DEFAULT_DRUMS_WAV.shape[0] != 1:
+    DEFAULT_DRUMS_WAV = DEFAULT_DRUMS_WAV.mean(0, keepdim=True)
+DEFAULT_DRUMS_WAV = DEFAULT_DRUMS_WAV.to(DEVICE)
+
 # Set generation parameters
 jasco_chords_drums.set_generation_params(
     cfg_coef_all=5.0,
     cfg_coef_txt=0.0
 )
 
-# Counter for output files
-file_counter = 1
+def run_generation(prompts, chord_progression, drums_wav, progress=False):
+    """Generate one track per prompt with JASCO, without autograd bookkeeping."""
+    with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.bfloat16, enabled=DEVICE == 'cuda'):
+        output = jasco_chords_drums.generate_music(
+            descriptions=prompts,
+            chords=chord_progression,
+            drums_wav=drums_wav,
+            drums_sample_rate=jasco_chords_drums.sample_rate,
+            progress=progress
+        )
+    return output.float()
+
+# All generations run on this one thread: torch.compile's CUDA graphs and their
+# memory pool are per thread, so warmup and requests must share it to reuse them
+generation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generation")
+
+def run_in_float32(fn):
+    """Wrap fn so it runs outside autocast, with floating point tensor arguments cast to float32."""
+    def to_float32(value):
+        return value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [to_float32(arg) for arg in args]
+        kwargs = {name: to_float32(value) for name, value in kwargs.items()}
+        with torch.autocast(DEVICE, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+# Generation always produces 10 s clips at small batch sizes, so compile the
+# transformer with CUDA graphs (captured during the warmup below)
+if DEVICE == 'cuda':
+    # Run the LM in bfloat16; the compression model stays in float32 for audio quality
+    jasco_chords_drums.lm = jasco_chords_drums.lm.to(dtype=torch.bfloat16)
+    jasco_chords_drums.compression_model.encode = run_in_float32(jasco_chords_drums.compression_model.encode)
+    jasco_chords_drums.compression_model.decode = run_in_float32(jasco_chords_drums.compression_model.decode)
+    jasco_chords_drums.lm.forward = torch.compile(jasco_chords_drums.lm.forward, mode='reduce-overhead', fullgraph=False)
+
+# Only one generation at a time on the single model instance
+# (created on startup so it binds to the server's event loop)
+inference_sem = None
+
+# LRU cache of generated tracks: request key -> output wav path
+OUTPUT_CACHE_SIZE = 128
+output_cache = OrderedDict()
+
+def make_cache_key(prompt, chord_progression, drums_digest=None):
+    """Hash the generation inputs into a cache key."""
+    data = prompt.encode() + orjson.dumps(chord_progression)
+    if drums_digest is not None:
+        data += drums_digest
+    return hashlib.blake2b(data).hexdigest()
+
+@functools.lru_cache(maxsize=8)
+def get_resampler(src, dst):
+    """Resampler for src -> dst Hz on DEVICE, keeping its sinc kernel across requests."""
+    return julius.ResampleFrac(src, dst, zeros=24).to(DEVICE)
+
+# Upload formats torchaudio can't reliably decode, sent straight to ffmpeg
+# (webm/opus come from browser MediaRecorder, m4a is missing on some builds)
+FFMPEG_ONLY_FORMATS = {'webm', 'opus', 'm4a'}
+
+# Content type subtypes whose name differs from the torchaudio format name
+CONTENT_TYPE_FORMATS = {'mpeg': 'mp3', 'x-wav': 'wav', 'wave': 'wav', 'x-flac': 'flac', 'mp4': 'm4a', 'x-m4a': 'm4a'}
+
+def upload_format(upload):
+    """Guess an upload's format from its extension, or its content type when there is none."""
+    extension = os.path.splitext(upload.filename or '')[1].lstrip('.').lower()
+    if extension:
+        return extension
+    # Blobs posted by the browser client arrive as "blob" with e.g. "audio/webm;codecs=opus"
+    content_type = (upload.content_type or '').split(';')[0].strip().lower()
+    kind, _, subtype = content_type.partition('/')
+    if kind in ('audio', 'video') and subtype:
+        return CONTENT_TYPE_FORMATS.get(subtype, subtype)
+    return None
+
+# Size of the chunks uploads are streamed in
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+async def hash_upload(upload):
+    """Hash an upload chunk by chunk, then rewind it for decoding."""
+    hasher = hashlib.blake2b()
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        hasher.update(chunk)
+    await upload.seek(0)
+    return hasher.digest()
+
+# Pool of ffmpeg processes started ahead of time, so uploads don't wait on fork+exec.
+# ffmpeg exits after one stream, so each used process is replaced in the background.
+# It is only a fallback decoder, so a couple of idle processes are enough; if ffmpeg
+# can't be started, pooling is disabled and uploads spawn their own process.
+FFMPEG_POOL_SIZE = 2
+ffmpeg_pool = None
+ffmpeg_pool_enabled = True
+ffmpeg_refills = set()
+
+async def spawn_ffmpeg():
+    """Start an ffmpeg process that waits on stdin for one upload."""
+    return await asyncio.create_subprocess_exec(
+        'ffmpeg', '-y', '-i', 'pipe:0', '-t', '10',
+        '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1',
+        '-ar', str(jasco_chords_drums.sample_rate), 'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+async def refill_ffmpeg_pool():
+    """Add a fresh ffmpeg process to the pool, disabling the pool if ffmpeg can't start."""
+    global ffmpeg_pool_enabled
+    try:
+        proc = await spawn_ffmpeg()
+    except OSError:
+        logger.warning("Could not start ffmpeg, disabling the ffmpeg pool", exc_info=True)
+        ffmpeg_pool_enabled = False
+        return
+    await ffmpeg_pool.put(proc)
+
+async def acquire_ffmpeg():
+    """Take a ready ffmpeg process from the pool, or spawn one if none is available."""
+    proc = None
+    if ffmpeg_pool_enabled:
+        try:
+            proc = ffmpeg_pool.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        else:
+            refill = asyncio.create_task(refill_ffmpeg_pool())
+            ffmpeg_refills.add(refill)
+            refill.add_done_callback(ffmpeg_refills.discard)
+    if proc is None or proc.returncode is not None:
+        # The pool is empty, disabled, or its process died while idle
+        proc = await spawn_ffmpeg()
+    return proc
+
+async def decode_with_ffmpeg(upload):
+    """Stream an upload through a pooled ffmpeg into mono float32 PCM at the model rate."""
+    try:
+        proc = await acquire_ffmpeg()
+    except OSError:
+        logger.exception("Could not start ffmpeg")
+        raise HTTPException(status_code=500, detail="ffmpeg is not available")
+
+    async def feed():
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg stops reading once it has the first 10 seconds
+            pass
+        finally:
+            proc.stdin.close()
+
+    try:
+        _, raw, err = await asyncio.gather(feed(), proc.stdout.read(), proc.stderr.read())
+        returncode = await proc.wait()
+    finally:
+        # Don't leave ffmpeg running if decoding failed or the request was cancelled
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    if returncode != 0:
+        logger.error("ffmpeg error: %s", err.decode(errors='replace'))
+        raise HTTPException(status_code=500, detail="Audio conversion failed")
+    if not raw:
+        raise HTTPException(status_code=400, detail="Uploaded drums contain no audio")
+    return torch.frombuffer(bytearray(raw), dtype=torch.float32).unsqueeze(0)
+
+# Generations in progress: cache key -> future resolving to the output wav path
+inflight_generations = {}
+
+# Inputs of cached requests, so variations can be generated without decoding again:
+# cache key -> (prompt, chord progression, drums on CPU or None for the defaults)
+variation_inputs = {}
+
+# Requests whose variation is currently being generated
+pending_variations = set()
+
+def alt_cache_key(key):
+    """Key under which the precomputed variation of a request is cached."""
+    return hashlib.blake2b((key + ':alt').encode()).hexdigest()
+
+def cache_output(key, output_file):
+    """Register a generated file, deleting the least recently used one when full."""
+    replaced_file = output_cache.get(key)
+    if replaced_file and replaced_file != output_file:
+        # Responses already handed out (and their X-File-Path) may still point at the
+        # replaced take, so leave it on disk until the LRU evicts it like any other file
+        output_cache[f"retired:{uuid.uuid4().hex}"] = replaced_file
+    output_cache[key] = output_file
+    output_cache.move_to_end(key)
+    while len(output_cache) > OUTPUT_CACHE_SIZE:
+        evicted_key, evicted_file = output_cache.popitem(last=False)
+        variation_inputs.pop(evicted_key, None)
+        if os.path.exists(evicted_file):
+            os.remove(evicted_file)
+
+def decode_drums(file, audio_format):
+    """Decode up to 10 s of an upload with torchaudio, returning (wav, sample rate) or None if it can't."""
+    try:
+        # Read the rate first so only the 10 second generation window is decoded
+        sample_rate = torchaudio.info(file, format=audio_format).sample_rate
+        file.seek(0)
+        return torchaudio.load(file, num_frames=int(10.0 * sample_rate), format=audio_format)
+    except RuntimeError:
+        file.seek(0)
+        return None
+
+def prepare_drums(drums_wav, drums_sr):
+    """Trim, downmix and resample decoded drums into a mono [1, T] tensor at the model rate on DEVICE."""
+    # Drop anything beyond the 10 second generation window (decoding is already bounded;
+    # this guards against decoders that return more than asked)
+    drums_wav = drums_wav[:, :int(10.0 * drums_sr)]
+    drums_wav = drums_wav.to(DEVICE, non_blocking=True)
+
+    # Verify audio format requirements
+    if drums_wav.shape[0] != 1 or drums_wav.dtype != torch.float32:
+        # Convert to mono float32 in a single pass
+        drums_wav = torch.mean(drums_wav, dim=0, keepdim=True, dtype=torch.float32)
+
+    if drums_sr != jasco_chords_drums.sample_rate:
+        # Resample to match model's sample rate (julius reduces the ratio by its GCD)
+        drums_wav = get_resampler(drums_sr, jasco_chords_drums.sample_rate)(drums_wav)
+
+    return drums_wav
+
+async def load_drums(drums):
+    """Decode an uploaded drum track into a mono [1, T] tensor at the model rate on DEVICE."""
+    try:
+        # Let torchaudio decode common formats from the spooled upload directly,
+        # in a worker thread so the event loop keeps serving other requests
+        audio_format = upload_format(drums)
+
+        decoded = None
+        if audio_format not in FFMPEG_ONLY_FORMATS:
+            decoded = await asyncio.to_thread(decode_drums, drums.file, audio_format)
+
+        if decoded is None:
+            # Fall back to ffmpeg, streaming the upload through stdin/stdout
+            decoded = await decode_with_ffmpeg(drums), jasco_chords_drums.sample_rate
+
+        return await asyncio.to_thread(prepare_drums, *decoded)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error processing drum audio")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Micro-batching of generations: requests arriving within BATCH_WAIT seconds
+# that share a chord progression run as one forward pass of up to MAX_BATCH_SIZE
+MAX_BATCH_SIZE = 4
+BATCH_WAIT = 0.05
+generation_queue = None
+batcher_task = None
+
+async def generate_audio(prompt, chord_progression, drums_wav):
+    """Queue a generation for the batcher and wait for its track."""
+    future = asyncio.get_running_loop().create_future()
+    await generation_queue.put((prompt, chord_progression, drums_wav, future))
+    return await future
+
+def pad_drums(drums):
+    """Stack [1, T] drum tensors into a [B, 1, T] batch, zero-padding to the longest."""
+    length = max(wav.shape[-1] for wav in drums)
+    return torch.stack([torch.nn.functional.pad(wav, (0, length - wav.shape[-1])) for wav in drums])
+
+async def next_batch():
+    """Wait for a request, then collect more until the batch is full or BATCH_WAIT passes."""
+    loop = asyncio.get_running_loop()
+    batch = [await generation_queue.get()]
+    deadline = loop.time() + BATCH_WAIT
+    while len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(generation_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def batch_generations():
+    """Run queued generations on the GPU, batching requests with the same chords."""
+    while True:
+        groups = {}
+        for item in await next_batch():
+            groups.setdefault(tuple(item[1]), []).append(item)
+
+        for chord_progression, items in groups.items():
+            prompts = [prompt for prompt, _, _, _ in items]
+            try:
+                drums_wav = pad_drums([wav for _, _, wav, _ in items])
+                async with inference_sem:
+                    output = await asyncio.get_running_loop().run_in_executor(
+                        generation_executor, run_generation, prompts, list(chord_progression), drums_wav
+                    )
+            except Exception as e:
+                for *_, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (*_, future), track in zip(items, output):
+                if not future.done():
+                    future.set_result(track)
+
+def start_batcher():
+    """Start the batcher task, restarting it if it ever dies."""
+    global batcher_task
+    batcher_task = asyncio.create_task(batch_generations())
+    batcher_task.add_done_callback(restart_batcher)
+
+def restart_batcher(task):
+    if task.cancelled():
+        return
+    logger.error("Generation batcher stopped, restarting it", exc_info=task.exception())
+    start_batcher()
+
+async def save_audio(output_path, audio, strategy="loudness"):
+    """Write a generated track to output_path + '.wav' in a worker thread."""
+    await asyncio.to_thread(
+        audio_write,
+        output_path, 
+        audio.cpu(), 
+        jasco_chords_drums.sample_rate,
+        strategy=strategy,
+        loudness_compressor=strategy == "loudness"
+    )
+
+async def normalize_loudness(output_path, audio):
+    """Replace a peak-normalized track with the loudness-normalized, compressed version."""
+    loud_path = f"{output_path}_loudness"
+    try:
+        await save_audio(loud_path, audio)
+        # Only swap the file in while the cache still tracks it, otherwise it would be
+        # recreated as an orphan; nothing awaits between this check and the replace
+        if f"{output_path}.wav" in output_cache.values():
+            os.replace(f"{loud_path}.wav", f"{output_path}.wav")
+    except Exception:
+        logger.exception("Error normalizing loudness")
+    finally:
+        # Left behind on failure, or when the track was evicted from the cache in the meantime
+        if os.path.exists(f"{loud_path}.wav"):
+            os.remove(f"{loud_path}.wav")
+
+async def precompute_variation(key, prompt, chord_progression, drums_wav):
+    """Generate another take of a request while the GPU is idle, so a regenerate is instant."""
+    if key in pending_variations or inference_sem.locked() or not generation_queue.empty():
+        return
+    pending_variations.add(key)
+    try:
+        drums_wav = DEFAULT_DRUMS_WAV if drums_wav is None else drums_wav.to(DEVICE)
+        track = await generate_audio(prompt, chord_progression, drums_wav)
+        alt_path = f"output/{uuid.uuid4().hex}"
+        await save_audio(alt_path, track)
+        cache_output(alt_cache_key(key), f"{alt_path}.wav")
+    except Exception:
+        logger.exception("Error generating variation")
+    finally:
+        pending_variations.discard(key)
+
+def schedule_variation(background, key):
+    """Queue a new variation of a cached request unless one is ready or underway."""
+    inputs = variation_inputs.get(key)
+    if inputs is not None and alt_cache_key(key) not in output_cache and key not in pending_variations:
+        background.add_task(precompute_variation, key, *inputs)
+
+# Warm up cuDNN autotuning, the allocator and the CUDA graphs for every batch
+# size before the server starts, so the first requests don't pay for it
+if DEVICE == 'cuda':
+    for batch_size in range(1, MAX_BATCH_SIZE + 1):
+        generation_executor.submit(
+            run_generation,
+            [DEFAULT_PROMPT] * batch_size,
+            DEFAULT_CHORDS,
+            DEFAULT_DRUMS_WAV[None].expand(batch_size, -1, -1)
+        ).result()
+
+@app.on_event("startup")
+async def create_inference_sem():
+    # On Python 3.9 a semaphore created at import binds to a different loop than uvicorn's
+    global inference_sem
+    inference_sem = asyncio.Semaphore(1)
+
+@app.on_event("startup")
+async def start_workers():
+    global ffmpeg_pool, generation_queue
+    ffmpeg_pool = asyncio.Queue()
+    for _ in range(FFMPEG_POOL_SIZE):
+        await refill_ffmpeg_pool()
+    generation_queue = asyncio.Queue()
+    start_batcher()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    global ffmpeg_pool_enabled
+    batcher_task.cancel()
+    generation_executor.shutdown(wait=False)
+    # Stop refilling, and let cancelled spawns kill the processes they started
+    ffmpeg_pool_enabled = False
+    refills = list(ffmpeg_refills)
+    for refill in refills:
+        refill.cancel()
+    await asyncio.gather(*refills, return_exceptions=True)
+    while not ffmpeg_pool.empty():
+        proc = ffmpeg_pool.get_nowait()
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
 
 @app.post('/generate')
 async def generate(
+    background: BackgroundTasks,
     prompt: str = Form(...),
     chords: Optional[str] = Form(None),
     drums: Optional[UploadFile] = Form(None)
 ):
     try:
-        global file_counter
-        
         # Create output directory if it doesn't exist
         os.makedirs("output", exist_ok=True)
         
         # Process chords
         if chords:
             try:
-                chord_list = json.loads(chords)
+                chord_list = orjson.loads(chords)
+                chord_progression = [(str(chord), float(time)) for chord, time in chord_list]
                 # Validate chord times don't exceed 10.0
-                if any(float(time) > 10.0 for _, time in chord_list):
+                times = np.fromiter((time for _, time in chord_progression), dtype=np.float64, count=len(chord_progression))
+                if (times > 10.0).any():
                     raise HTTPException(
                         status_code=400, 
                         detail="Chord times cannot exceed 10.0 seconds"
                     )
-                chord_progression = [(str(chord), float(time)) for chord, time in chord_list]
-            except json.JSONDecodeError:
-                print("Invalid chord format provided, using default chords")
+            except orjson.JSONDecodeError:
+                logger.debug("Invalid chord format provided, using default chords")
                 chord_progression = DEFAULT_CHORDS
         else:
-            print("No chords provided, using default chords")
+            logger.debug("No chords provided, using default chords")
             chord_progression = DEFAULT_CHORDS
 
-        # Process drums from mic input
-        if drums and drums.filename:
-            print("1")
-            try:
-                # Save uploaded file to a temp file (original format)
-                with tempfile.NamedTemporaryFile(suffix=os.path.splitext(drums.filename)[1], delete=False) as temp_audio:
-                    content = await drums.read()
-                    temp_audio.write(content)
-                    temp_audio.flush()
-                    temp_audio_path = temp_audio.name
-                    print("2")
-
-                # Convert to WAV using ffmpeg
-                temp_wav = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-                temp_wav.close()
-                temp_wav_path = temp_wav.name
-
-                try:
-                    (
-                        ffmpeg
-                        .input(temp_audio_path)
-                        .output(temp_wav_path, format='wav', acodec='pcm_s16le', ac=1)
-                        .run(quiet=True, overwrite_output=True)
-                    )
-                except ffmpeg.Error as e:
-                    print("ffmpeg error:", e)
-                    raise HTTPException(status_code=500, detail="Audio conversion failed")
-
-                # Load and process the WAV file
-                drums_wav, drums_sr = torchaudio.load(temp_wav_path, format="wav")
-                print("3")
-
-                # Verify audio format requirements
-                if drums_wav.shape[0] != 1:
-                    print("4")    
-                    # Convert to mono if necessary
-                    drums_wav = drums_wav.mean(dim=0, keepdim=True)
-                    print("5")
-
-                if drums_sr != jasco_chords_drums.sample_rate:
-                    # Resample to match model's sample rate
-                    resampler = torchaudio.transforms.Resample(drums_sr, jasco_chords_drums.sample_rate)
-                    drums_wav = resampler(drums_wav)
-                    print("6") 
-
-                # Clean up temp files
-                os.unlink(temp_audio_path)
-                os.unlink(temp_wav_path)
-                print("7")
+        # Hash the uploaded drums without pulling the whole file into memory
+        drums_digest = await hash_upload(drums) if drums and drums.filename else None
 
-            except Exception as e:
-                print(f"Error processing drum audio: {str(e)}")
-                raise HTTPException(status_code=500, detail=str(e))
-        else:
-            print("No custom drums provided, using only prompt and default chords")
-            # drums_wav, drums_sr = DEFAULT_DRUMS_WAV, DEFAULT_DRUMS_SR
-
-        # Find next available file number
-        while os.path.exists(f"output/{file_counter}.wav"):
-            file_counter = (file_counter % 999) + 1
-
-        # Path to output
-        output_path = f"output/{file_counter}"
-        output_file = f"output/{file_counter}.wav"
-
-        # Generate music using the custom drums
-        if drums and drums.filename:
-            output = jasco_chords_drums.generate_music(
-                descriptions=[prompt or DEFAULT_PROMPT],
-                chords=chord_progression,
-                drums_wav=drums_wav,
-                drums_sample_rate=jasco_chords_drums.sample_rate,
-                progress=True
+        # Serve a previously generated track for identical inputs, preferring
+        # the precomputed variation, which then replaces the original take
+        cache_key = make_cache_key(prompt or DEFAULT_PROMPT, chord_progression, drums_digest)
+        alt_file = output_cache.pop(alt_cache_key(cache_key), None)
+        if alt_file and os.path.exists(alt_file):
+            cache_output(cache_key, alt_file)
+        cached_file = output_cache.get(cache_key)
+        if cached_file and os.path.exists(cached_file):
+            output_cache.move_to_end(cache_key)
+            # Warm the next take so every regenerate stays instant
+            schedule_variation(background, cache_key)
+            return FileResponse(
+                cached_file,
+                media_type="audio/wav",
+                headers={"X-File-Path": os.path.splitext(cached_file)[0]}
             )
-        else:
-            # Generate music without using custom drums
-            output = jasco_chords_drums.generate_music(
-                descriptions=[prompt or DEFAULT_PROMPT],
-                chords=chord_progression,
-                progress=True
+
+        # Wait for an identical request that is already generating instead of duplicating it;
+        # its errors are re-raised here, and if it was cancelled this request takes over
+        while (inflight := inflight_generations.get(cache_key)) is not None:
+            try:
+                shared_file = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if inflight.cancelled():
+                    continue
+                raise
+            return FileResponse(
+                shared_file,
+                media_type="audio/wav",
+                headers={"X-File-Path": os.path.splitext(shared_file)[0]}
             )
+        inflight = asyncio.get_running_loop().create_future()
+        inflight_generations[cache_key] = inflight
 
-        # Save the generated audio
-        audio_write(
-            output_path, 
-            output[0].cpu(), 
-            jasco_chords_drums.sample_rate,
-            strategy="loudness",
-            loudness_compressor=True
-        )
+        try:
+            # Process drums from mic input
+            if drums_digest is not None:
+                drums_wav = await load_drums(drums)
+            else:
+                logger.debug("No custom drums provided, using default drums")
+                drums_wav = DEFAULT_DRUMS_WAV
+
+            # Give every generated track its own file; the cache maps inputs to it
+            output_path = f"output/{uuid.uuid4().hex}"
+
+            # Generate music using the custom or default drums, batched with concurrent requests
+            track = await generate_audio(prompt or DEFAULT_PROMPT, chord_progression, drums_wav)
+
+            # Save the generated audio with cheap peak normalization for a fast response,
+            # then swap in the loudness-normalized version once the response has been sent
+            await save_audio(output_path, track, strategy="peak")
+            background.add_task(normalize_loudness, output_path, track)
+
+            output_file = f"{output_path}.wav"
+            cache_output(cache_key, output_file)
+            variation_inputs[cache_key] = (
+                prompt or DEFAULT_PROMPT,
+                chord_progression,
+                None if drums_digest is None else drums_wav.cpu()
+            )
+        except asyncio.CancelledError:
+            inflight.cancel()
+            raise
+        except BaseException as e:
+            # Identical requests waiting on this one fail with the same error
+            inflight.set_exception(e)
+            # Mark it retrieved so asyncio doesn't log it again when nobody was waiting
+            inflight.exception()
+            raise
+        else:
+            inflight.set_result(output_file)
+        finally:
+            del inflight_generations[cache_key]
 
-        # Increment counter for next generation
-        file_counter = (file_counter % 999) + 1
+        # Keep a variation warm for a likely regenerate
+        schedule_variation(background, cache_key)
 
         return FileResponse(
             output_file,
@@ -170,11 +589,13 @@ async def generate(
             headers={"X-File-Path": output_path}
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error generating music: {str(e)}")
+        logger.exception("Error generating music")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, http="httptools", loop="uvloop")
\ No newline at end of file